@@ -1,11 +1,30 @@
 import argparse
+import math
 import os
 import pathlib
 import re
 import shutil
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from time import sleep
-from typing import List, Optional
+from typing import Iterable, Iterator, List, Set, Tuple
+
+if sys.platform == "win32":
+    import ctypes
+    from ctypes import wintypes
+
+    _kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+    _CopyFileExW = _kernel32.CopyFileExW
+    _CopyFileExW.argtypes = [
+        wintypes.LPCWSTR,
+        wintypes.LPCWSTR,
+        ctypes.c_void_p,
+        ctypes.c_void_p,
+        ctypes.c_void_p,
+        wintypes.DWORD,
+    ]
+    _CopyFileExW.restype = wintypes.BOOL
 
 """
 The purpose of this script is to copy matching files from a source directory
@@ -35,6 +54,36 @@ EXTS_MEDIA = ["mp3", "m4a"]
 EXTS_ART = ["jpg"]
 EXTS_LYRICS = ["lrc"]
 
+# Binary prefixes used by sizeof_fmt
+_SIZE_UNITS = ("", "Ki", "Mi", "Gi", "Ti", "Pi", "Ei", "Zi", "Yi")
+
+# Maps each file extension of interest to its kind of file, so directory
+# entries are classified with a single dict lookup
+_EXT_KIND = {
+    **{ext: "media" for ext in EXTS_MEDIA},
+    **{ext: "art" for ext in EXTS_ART},
+    **{ext: "lyrics" for ext in EXTS_LYRICS},
+}
+
+# Album subfolders which never contain tracks to copy (hidden folders are
+# skipped as well). Other subfolders, e.g. "CD1", "CD2", are searched.
+SKIPPED_ALBUM_SUBDIRS = {"scans", "artwork", "booklet"}
+
+# Album folders are labeled with the year in square brackets, e.g. "Album [1983]"
+_YEAR_RE = re.compile(r"\[(\d{4})\]")
+
+# Album directories are processed concurrently; the work is bound by
+# filesystem metadata latency rather than CPU
+MAX_WALK_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+# Number of files copied concurrently
+MAX_COPY_WORKERS = 8
+
+# Files to be copied from one album: (absolute album path, album path relative
+# to the media library, [(file path relative to the album, file size in bytes)]).
+# The album paths are stored once per album instead of in every file path.
+AlbumFiles = Tuple[str, str, List[Tuple[str, int]]]
+
 
 def query_yes_no(question, default="yes") -> bool:
     """Ask a yes/no question via raw_input() and return their answer.
@@ -67,10 +116,6 @@ def query_yes_no(question, default="yes") -> bool:
             sys.stdout.write("Please respond with 'yes' or 'no' " "(or 'y' or 'n').\n")
 
 
-def get_path_depth(path: str) -> int:
-    return len(path.strip(os.path.sep).split(os.path.sep))
-
-
 def get_file_ext(path: str) -> str:
     _, ext = os.path.splitext(path)
     return ext.strip(".")
@@ -78,113 +123,179 @@ def get_file_ext(path: str) -> str:
 
 def is_file_type_media(path: str) -> bool:
     ext = get_file_ext(path)
-    return ext in EXTS_MEDIA
+    return _EXT_KIND.get(ext.lower()) == "media"
 
 
-def sizeof_fmt(num, suffix="B") -> None:
-    for unit in ("", "Ki", "Mi", "Gi", "Ti", "Pi", "Ei", "Zi"):
-        if abs(num) < 1024.0:
-            return f"{num:3.1f} {unit}{suffix}"
-        num /= 1024.0
-    return f"{num:.1f} Yi{suffix}"
+def sizeof_fmt(num, suffix="B") -> str:
+    # Index of the largest unit not exceeding num: floor(log2(num) / 10),
+    # computed exactly on the integer part rather than with a float log
+    i = min(max((int(abs(num)).bit_length() - 1) // 10, 0), len(_SIZE_UNITS) - 1)
+    return f"{num / (1 << (10 * i)):3.1f} {_SIZE_UNITS[i]}{suffix}"
 
 
-def process_album_dir(
-    album_path: str, min_year: Optional[int], max_year: Optional[int]
-) -> List[str]:
-    """Returns a list of absolute file paths to files which should be copied,
-    including .mp3/.m4a, .lrc and .jpg (cover art) files."""
-    ret = []
-    tokens = album_path.split(os.path.sep)
-    album_name = tokens[-1]
-    artist_name = tokens[-2]
-
-    album_year = 0
+def get_album_year(album_name: str) -> int:
+    """Returns the year of an album directory named like "Album [1983]",
+    exiting if there is none."""
     try:
-        album_year = int(re.findall("\[(\d{4})\]", album_name)[-1])
+        return int(_YEAR_RE.findall(album_name)[-1])
     except Exception as e:
         print("Exception processing album: " + album_name)
         print(e)
         sys.exit(1)
 
-    if (min_year is None or album_year >= int(min_year)) and (
-        max_year is None or album_year <= int(max_year)
-    ):
-        for root, _, files in os.walk(album_path):
-            for f in files:
-                ext = get_file_ext(f)
-                if ext in EXTS_LYRICS:
-                    ret.append(os.path.join(root, f))
-                    # Find media file associated with LRC file
-                    basename, ext = os.path.splitext(f)
-                    for ext in EXTS_MEDIA:
-                        mf = os.path.join(root, basename + "." + ext)
-                        if os.path.exists(mf):
-                            ret.append(mf)
-                elif ext in EXTS_ART:
-                    ret.append(os.path.join(root, f))
-    return ret
-
-
-def copy_file(source_dir: str, dest_dir: str, source_file_abspath: str) -> None:
-    """Copy specified file to destination directory, preserving directory structure
-    and creating destination subdirectories as needed.
+
+def process_album_dir(
+    album_path: str, album_rel_path: str, min_year: float, max_year: float
+) -> AlbumFiles:
+    """Returns the album's files which should be copied, including .mp3/.m4a,
+    .lrc and .jpg (cover art) files."""
+    ret = []
+    album_year = get_album_year(os.path.basename(album_rel_path))
+
+    if min_year <= album_year <= max_year:
+        # One listing per (disc) directory; media files are matched to their
+        # LRC files by basename lookup rather than probing the filesystem.
+        # Sizes come from the directory entries, which are only stat'ed
+        # once they are selected (free on Windows)
+        media_by_base = {}
+        lrcs = []
+        selected = []
+        dirs = [album_path]
+        while dirs:
+            with os.scandir(dirs.pop()) as it:
+                for entry in it:
+                    _, dot, ext = entry.name.rpartition(".")
+                    kind = _EXT_KIND.get(ext.lower()) if dot else None
+                    if kind is None:
+                        if (
+                            entry.is_dir(follow_symlinks=False)
+                            and not entry.name.startswith(".")
+                            and entry.name.lower() not in SKIPPED_ALBUM_SUBDIRS
+                        ):
+                            dirs.append(entry.path)
+                        continue
+                    if not entry.is_file(follow_symlinks=False):
+                        continue
+                    if kind == "art":
+                        selected.append(entry)
+                        continue
+                    # Path without the extension, which pairs media with lyrics
+                    base = entry.path[: -len(ext) - 1]
+                    if kind == "lyrics":
+                        lrcs.append((base, entry))
+                    else:
+                        media_by_base.setdefault(base, []).append(entry)
+        for base, lrc in lrcs:
+            if base in media_by_base:
+                selected.append(lrc)
+                selected.extend(media_by_base[base])
+        prefix_len = len(album_path) + 1
+        for entry in selected:
+            ret.append(
+                (entry.path[prefix_len:], entry.stat(follow_symlinks=False).st_size)
+            )
+    return album_path, album_rel_path, ret
+
+
+def make_dirs(path: str, made_dirs: Set[str]) -> None:
+    """Create directory path and any missing parents, skipping the syscalls
+    entirely if it is already in made_dirs (the directories created so far
+    by the current copy)."""
+    if path in made_dirs:
+        return
+    pathlib.Path(path).mkdir(parents=True, exist_ok=True)
+    made_dirs.add(path)
+
+
+def copy_file(src: str, dst: str, made_dirs: Set[str]) -> None:
+    """Copy specified file to its destination path, creating destination
+    subdirectories as needed (see make_dirs).
 
     E.g. given:
-    source_dir="D:\\Music"
-    dest_dir="D:\\Playlists\\1990"
-    source_file_abspath="D:\\Music\\Martha and the Muffins\\Danseparc [1983]\\01 - Obedience.mp3"
+    src="D:\\Music\\Martha and the Muffins\\Danseparc [1983]\\01 - Obedience.mp3"
+    dst="D:\\Playlists\\1990\\Martha and the Muffins\\Danseparc [1983]\\01 - Obedience.mp3"
 
     It will create the two destination subdirectories:
     "D:\\Playlists\\1990\\Martha and the Muffins"
     "D:\\Playlists\\1990\\Martha and the Muffins\\Danseparc [1983]"
-
-    And copy the file to:
-    "D:\\Playlists\\1990\\Martha and the Muffins\\Danseparc [1983]\\01 - Obedience.mp3"
     """
-    # First we need to compute the relative path by stripping the source_dir
-    if not source_file_abspath.startswith(source_dir):
-        raise Exception("Source file path doesn't match source directory")
-    rel_file_path = source_file_abspath.replace(source_dir, '').strip(os.path.sep)
-    # rel_path_path is now like "Martha and the Muffins\\Danseparc [1983]\\01 - Obedience.mp3"
-    dest_file_abspath = os.path.join(dest_dir, rel_file_path)
-    # dest_file_abspath is now like "D:\\Playlists\\1990\\Martha and the Muffins\\Danseparc [1983]\\01 - Obedience.mp3"
-    dest_dir_abspath, _ = os.path.split(dest_file_abspath)
-    # dest_dir_abspath is now like "D:\\Playlists\\1990\\Martha and the Muffins\\Danseparc [1983]"
-    # make necessary subdirectories
-    pathlib.Path(dest_dir_abspath).mkdir(parents=True, exist_ok=True)
-    # copy file
-    shutil.copy(source_file_abspath, dest_file_abspath)
+    make_dirs(os.path.dirname(dst), made_dirs)
+    if sys.platform == "win32":
+        # shutil copies synchronously with alternating reads and writes on
+        # Windows; the system copy engine overlaps them itself and keeps the
+        # data out of user space
+        if not _CopyFileExW(src, dst, None, None, None, 0):
+            raise ctypes.WinError(ctypes.get_last_error())
+    else:
+        # copyfile hands the data off to the kernel (sendfile/fcopyfile);
+        # calling it directly skips the is-a-directory stat that copy() does
+        # on dst, which is always a file path here
+        shutil.copyfile(src, dst)
+        shutil.copymode(src, dst)
+
+
+def find_album_dirs(media_path: str) -> List[Tuple[str, str]]:
+    """Returns a list of (absolute path, path relative to media_path) pairs for
+    the album directories (media_path/artist/album [year]) of the media library.
+
+    The relative path is built from the directory names, e.g.
+    "Martha and the Muffins\\Danseparc [1983]", so it doesn't depend on which
+    separators media_path was given with."""
+    album_dirs = []
+    # Descend exactly two levels (artist, then album) rather than walking
+    # every file in the library
+    with os.scandir(media_path) as artists:
+        for artist in artists:
+            if not artist.is_dir(follow_symlinks=False):
+                continue
+            with os.scandir(artist.path) as albums:
+                for album in albums:
+                    if album.is_dir(follow_symlinks=False):
+                        album_dirs.append(
+                            (album.path, os.path.join(artist.name, album.name))
+                        )
+    return album_dirs
+
+
+def iter_media_dir(
+    album_dirs: List[Tuple[str, str]], min_year: float, max_year: float
+) -> Iterator[AlbumFiles]:
+    """Yields the files to be copied from album_dirs (see find_album_dirs)
+    album by album, as soon as each album has been processed. Albums without
+    any files to copy are skipped."""
+    with ThreadPoolExecutor(max_workers=MAX_WALK_WORKERS) as executor:
+        # map() yields results in submission order, keeping the output stable
+        for album in executor.map(
+            lambda a: process_album_dir(*a, min_year, max_year), album_dirs
+        ):
+            if album[2]:
+                yield album
 
 
 def walk_media_dir(
-    media_path: str, min_year: Optional[int], max_year: Optional[int]
-) -> List[str]:
-    files = []
-    base_depth = get_path_depth(media_path)
-    for root, dirs, _ in os.walk(media_path, topdown=False):
-        for name in dirs:
-            fullpath = os.path.join(root, name)
-            current_depth = get_path_depth(fullpath)
-            # 1 = artist dir
-            # 2 = album [year] dir
-            if current_depth - base_depth == 2:
-                files.extend(process_album_dir(fullpath, min_year, max_year))
-    return files
-
-
-def show_copy_stats(files: List[str]) -> None:
+    media_path: str, min_year: float, max_year: float
+) -> List[AlbumFiles]:
+    return list(iter_media_dir(find_album_dirs(media_path), min_year, max_year))
+
+
+def show_copy_stats(albums: List[AlbumFiles]) -> None:
     print("Files to be copied:")
     tot_size_bytes = 0
+    file_count = 0
     media_file_count = 0
-    for f in files:
-        print(f)
-        fstat = os.stat(f)
-        tot_size_bytes += fstat.st_size
-        if is_file_type_media(f):
-            media_file_count += 1
+    lines = []
+    for album_path, _, files in albums:
+        file_count += len(files)
+        for f, size in files:
+            lines.append(os.path.join(album_path, f) + "\n")
+            tot_size_bytes += size
+            if is_file_type_media(f):
+                media_file_count += 1
+    # A single write rather than a print() (stdout lock, and a flush on a
+    # terminal) per file
+    sys.stdout.write("".join(lines))
     print(
-        f"Total number of files to be copied (including media/lyrics/art): {len(files)}"
+        f"Total number of files to be copied (including media/lyrics/art): {file_count}"
     )
     print(f"Total number of media files to be copied: {media_file_count}")
     print(
@@ -192,30 +303,128 @@ def show_copy_stats(files: List[str]) -> None:
     )
 
 
-def show_copy_proceed_menu(files: List[str], dest_dir: str) -> bool:
+def show_copy_proceed_menu(
+    albums: List[AlbumFiles], dest_dir: str, overwrite: bool = False
+) -> bool:
     if not query_yes_no("Proceed with copy?"):
         print("Copy aborted")
         return False
     print("Proceeding with copy")
+    return show_overwrite_menu(dest_dir, overwrite)
+
+
+def show_overwrite_menu(dest_dir: str, overwrite: bool = False) -> bool:
+    """Clears dest_dir if it exists, asking first unless overwrite is set.
+    Returns False if the user declined."""
     if os.path.exists(dest_dir):
-        if not query_yes_no(
+        if not overwrite and not query_yes_no(
             "Destination folder exists, are you sure you wish to overwrite it (all contents will be lost)?"
         ):
             print("Copy aborted")
             return False
-        else:
-            shutil.rmtree(dest_dir)
-            sleep(1)  # attempt to avoid permission denied isssue
-            os.mkdir(dest_dir)
-            print("Existing folder deleted successfully. Proceeding with copy")
+        clear_dest_dir(dest_dir)
     return True
 
 
-def copy_files(files: List[str], source_dir: str, dest_dir: str) -> None:
-    for i, f in enumerate(files):
-        print(f"Copying file {i+1} of {len(files)}: {f}")
-        copy_file(source_dir, dest_dir, f)
-    print(f"Copied {len(files)} files")
+def check_dest_dir(source_dir: str, dest_dir: str) -> None:
+    """Exits if dest_dir is the media library itself or one of its parent
+    folders, since clearing it would delete the library."""
+    source = os.path.normcase(os.path.realpath(source_dir))
+    dest = os.path.normcase(os.path.realpath(dest_dir))
+    try:
+        contains_source = os.path.commonpath([source, dest]) == dest
+    except ValueError:
+        # Different drives
+        contains_source = False
+    if contains_source:
+        print(
+            "Destination folder must not be the media library or one of its parent folders"
+        )
+        sys.exit(1)
+
+
+def clear_dest_dir(dest_dir: str) -> None:
+    shutil.rmtree(dest_dir)
+    sleep(1)  # attempt to avoid permission denied isssue
+    os.mkdir(dest_dir)
+    print("Existing folder deleted successfully. Proceeding with copy")
+
+
+def copy_files(albums: List[AlbumFiles], dest_dir: str) -> None:
+    # Full paths are only built now, when they're needed
+    dest_files = [
+        (os.path.join(album_path, f), os.path.join(dest_dir, album_rel_path, f))
+        for album_path, album_rel_path, files in albums
+        for f, _ in files
+    ]
+    # Create the destination directories up front, once each, so the copy
+    # workers don't race on creating them. Every parent up to dest_dir is
+    # included and they are created shortest first, so each parent already
+    # exists when its children are created.
+    dest_subdirs = {dest_dir}
+    for _, dst in dest_files:
+        d = os.path.dirname(dst)
+        while len(d) > len(dest_dir) and d not in dest_subdirs:
+            dest_subdirs.add(d)
+            d = os.path.dirname(d)
+    made_dirs: Set[str] = set()
+    for d in sorted(dest_subdirs, key=len):
+        make_dirs(d, made_dirs)
+    with ThreadPoolExecutor(max_workers=MAX_COPY_WORKERS) as executor:
+        futures = {
+            executor.submit(copy_file, f, dst, made_dirs): f for f, dst in dest_files
+        }
+        for i, future in enumerate(as_completed(futures)):
+            future.result()
+            print(f"Copied file {i+1} of {len(dest_files)}: {futures[future]}")
+    print(f"Copied {len(dest_files)} files")
+
+
+def stream_copy_files(albums: Iterable[AlbumFiles], dest_dir: str) -> None:
+    """Copy files while they are still being produced (e.g. by iter_media_dir),
+    so copying starts with the first album instead of after the whole media
+    library has been walked."""
+
+    made_dirs: Set[str] = set()
+    copied = 0
+    copied_lock = threading.Lock()
+    failed = threading.Event()
+
+    def copy_and_report(src: str, dst: str) -> None:
+        nonlocal copied
+        try:
+            copy_file(src, dst, made_dirs)
+        except Exception:
+            failed.set()
+            raise
+        with copied_lock:
+            # Numbered in the order the copies finish
+            copied += 1
+            sys.stdout.write(f"Copied file {copied}: {src}\n")
+
+    files_to_copy = (
+        (os.path.join(album_path, f), os.path.join(dest_dir, album_rel_path, f), size)
+        for album_path, album_rel_path, files in albums
+        for f, size in files
+    )
+    tot_size_bytes = 0
+    with ThreadPoolExecutor(max_workers=MAX_COPY_WORKERS) as executor:
+        futures = []
+        for src, dst, size in files_to_copy:
+            if failed.is_set():
+                break
+            futures.append(executor.submit(copy_and_report, src, dst))
+            tot_size_bytes += size
+        if failed.is_set():
+            # Don't start the copies still queued behind the failed one
+            for future in futures:
+                future.cancel()
+        for future in futures:
+            if not future.cancelled():
+                future.result()
+    print(
+        f"Copied {len(futures)} files, {tot_size_bytes} bytes ({sizeof_fmt(tot_size_bytes)})"
+    )
 
 
 def main():
@@ -241,12 +450,43 @@ def main():
         help="filter by maximum album year",
     )
 
+    parser.add_argument(
+        "-y",
+        "--yes",
+        action="store_true",
+        help="don't ask for confirmation to proceed and start copying while the "
+        "media library is still being scanned",
+    )
+
+    parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="delete the contents of dest_dir, if it exists, without asking",
+    )
+
     args = parser.parse_args()
 
-    files = walk_media_dir(args.source_dir, args.min_year, args.max_year)
-    show_copy_stats(files)
-    if show_copy_proceed_menu(files, args.dest_dir):
-        copy_files(files, args.source_dir, args.dest_dir)
+    # An unset year bound doesn't filter anything
+    min_year = -math.inf if args.min_year is None else args.min_year
+    max_year = math.inf if args.max_year is None else args.max_year
+
+    check_dest_dir(args.source_dir, args.dest_dir)
+
+    if args.yes:
+        album_dirs = find_album_dirs(args.source_dir)
+        # Fail on a badly named album before anything in dest_dir is deleted
+        for _, album_rel_path in album_dirs:
+            get_album_year(os.path.basename(album_rel_path))
+        if show_overwrite_menu(args.dest_dir, args.overwrite):
+            stream_copy_files(
+                iter_media_dir(album_dirs, min_year, max_year), args.dest_dir
+            )
+        return
+
+    albums = walk_media_dir(args.source_dir, min_year, max_year)
+    show_copy_stats(albums)
+    if show_copy_proceed_menu(albums, args.dest_dir, args.overwrite):
+        copy_files(albums, args.dest_dir)
 
 
 if __name__ == "__main__":